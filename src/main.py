@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import time
 import logging
 import sys
@@ -6,9 +7,10 @@ import json
 import os
 import tempfile
 import re
+import ssl
 import paho.mqtt.client as mqtt
 from ros_publisher import RosPointPerfectPublisher
-from point_perfect_client import PointPerfectClient
+from point_perfect_client import PointPerfectClient, json_loads
 
 STATS = 100  # logging level for stats
 
@@ -28,8 +30,8 @@ def load_json_credentials(args, argp):
         argp.error('Cannot use -j/--json with -i/--client_id, -d/--dir, -s/--server, or --lband')
 
     try:
-        with open(args.json, 'r', encoding='utf-8') as json_file:
-            json_data = json.load(json_file)
+        with open(args.json, 'rb') as json_file:
+            json_data = json_loads(json_file.read())
             json_file.close()
             conn = json_data['MQTT']['Connectivity']
             args.client_id = conn['ClientID']
@@ -48,20 +50,82 @@ def load_json_credentials(args, argp):
         argp.error(f'JSON file {args.json} is not valid')
 
     # Parse the server URI
-    match = re.match(r'(tcp|ssl)://(.+):(\d+)', server_uri)
-    args.server = match.group(2)
-    assert match.group(1) == 'ssl'
-    assert match.group(3) == '8883'
-
-    # Write the credentials to temporary files, as needed by paho.mqtt.client
-    (keyf, args.keyfile) = tempfile.mkstemp(
-                                prefix=f'device-{args.client_id}-', suffix='-pp-key.pem')
-    os.write(keyf, f'{KEY_HEADER}{key}{KEY_FOOTER}'.encode('ascii'))
-    os.close(keyf)
-    (certf, args.certfile) = tempfile.mkstemp(
-                                prefix=f'device-{args.client_id}-', suffix='-pp-cert.crt')
-    os.write(certf, f'{CERT_HEADER}{cert}{CERT_FOOTER}'.encode('ascii'))
-    os.close(certf)
+    match = re.fullmatch(r'ssl://([^:/\s]+):(\d+)', server_uri)
+    if not match:
+        argp.error(f'JSON file {args.json} has unsupported server URI {server_uri}')
+    args.server = match.group(1)
+    assert match.group(2) == '8883'
+
+    # The ssl module only loads the key/cert from files, so write the credentials
+    # to a private temporary directory that is removed as soon as they are loaded
+    with tempfile.TemporaryDirectory(prefix=f'device-{args.client_id}-') as tmp_dir:
+        keyfile = os.path.join(tmp_dir, 'pp-key.pem')
+        with open(keyfile, 'w', encoding='ascii') as key_file:
+            key_file.write(f'{KEY_HEADER}{key}{KEY_FOOTER}')
+        certfile = os.path.join(tmp_dir, 'pp-cert.crt')
+        with open(certfile, 'w', encoding='ascii') as cert_file:
+            cert_file.write(f'{CERT_HEADER}{cert}{CERT_FOOTER}')
+        args.tls_context = create_tls_context(certfile, keyfile)
+
+
+class SessionCachingSSLSocket(ssl.SSLSocket):
+    '''
+    SSL socket that hands its TLS session back to its context when closed, and
+    checks the server certificate against the context's pinned fingerprints.
+    '''
+
+    def do_handshake(self, *args, **kwargs):
+        super().do_handshake(*args, **kwargs)
+        if self.context.fingerprints:
+            fingerprint = hashlib.sha256(self.getpeercert(binary_form=True)).digest()
+            if fingerprint not in self.context.fingerprints:
+                raise ssl.SSLCertVerificationError(
+                    f'server certificate {fingerprint.hex()} does not match any pinned fingerprint')
+
+    def close(self):
+        if self.server_hostname and self.session:
+            self.context.sessions[self.server_hostname] = self.session
+        super().close()
+
+
+class SessionCachingSSLContext(ssl.SSLContext):
+    '''
+    SSL context that resumes the last TLS session with a server, if any.
+    paho-mqtt wraps a new socket on every (re)connect; offering the cached
+    session saves the full handshake when switching back and forth between
+    servers or reconnecting after a disconnect.
+    '''
+    sslsocket_class = SessionCachingSSLSocket
+
+    def __init__(self, *args, **kwargs):
+        del args, kwargs  # handled by SSLContext.__new__()
+        super().__init__()
+        self.sessions = {}  # server hostname -> ssl.SSLSession
+        self.fingerprints = None  # SHA-256 of accepted server certificates, see pin_certificates()
+
+    def pin_certificates(self, fingerprints):
+        '''
+        Only accept server certificates with one of the given SHA-256 fingerprints.
+        This replaces the chain verification against the system CA store by a
+        single hash comparison per handshake.
+        '''
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self.fingerprints = frozenset(fingerprints)
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname,
+                                   session=session, **kwargs)
+
+
+def create_tls_context(certfile, keyfile):
+    '''Create the TLS context for the MQTT connection, using the given client key/cert.'''
+    context = SessionCachingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
 
 
 def main():
@@ -71,6 +135,9 @@ def main():
         help='u-center JSON file containing MQTT credentials')
     argp.add_argument('--assistnow', action='store_true',
         help='Use AssistNow regardless of GNSS receiver state')
+    argp.add_argument('--pin', action='append',
+        help='SHA-256 fingerprint (hex) of an accepted MQTT server certificate, replacing '
+             'verification against the system CA store (can be given multiple times)')
 
     s_group = argp.add_mutually_exclusive_group()
     s_group.add_argument('--region', default=None,
@@ -130,30 +197,38 @@ def main():
         if args.tile_level != argp.get_default('tile_level'):
             argp.error('--tile-level requires --localized')
 
-    try:
-        if args.json:
-            load_json_credentials(args, argp)
-        else:
-            if not args.client_id:
-                argp.error('Either -j/--json or -i/--client_id must be specified')
-            args.certfile = os.path.join(args.dir, f'device-{args.client_id}-pp-cert.crt')
-            args.keyfile  = os.path.join(args.dir, f'device-{args.client_id}-pp-key.pem')
-            if not os.path.exists(args.certfile):
-                argp.error(f'Certificate file {args.certfile} does not exist')
-            if not os.path.exists(args.keyfile):
-                argp.error(f'Key file {args.keyfile} does not exist')
-
-        mqtt_client = mqtt.Client(client_id=args.client_id)
-        mqtt_client.tls_set(certfile=args.certfile, keyfile=args.keyfile)
-        mqtt_client.enable_logger()
-    finally:
-        if args.json:
-            # remove the temporary key/cert as early as possible
-            # they do get loaded in tls_set() and are not used thereafter
-            if 'certfile' in args and os.path.exists(args.certfile):
-                os.remove(args.certfile)
-            if 'keyfile' in args and os.path.exists(args.keyfile):
-                os.remove(args.keyfile)
+    if args.pin:
+        try:
+            args.pin = [bytes.fromhex(pin.replace(':', '')) for pin in args.pin]
+        except ValueError:
+            args.pin = []
+        if not args.pin or any(len(pin) != 32 for pin in args.pin):
+            argp.error('--pin must be a hexadecimal SHA-256 fingerprint')
+
+    if args.json:
+        load_json_credentials(args, argp)
+    else:
+        if not args.client_id:
+            argp.error('Either -j/--json or -i/--client_id must be specified')
+        args.certfile = os.path.join(args.dir, f'device-{args.client_id}-pp-cert.crt')
+        args.keyfile  = os.path.join(args.dir, f'device-{args.client_id}-pp-key.pem')
+        if not os.path.exists(args.certfile):
+            argp.error(f'Certificate file {args.certfile} does not exist')
+        if not os.path.exists(args.keyfile):
+            argp.error(f'Key file {args.keyfile} does not exist')
+        args.tls_context = create_tls_context(args.certfile, args.keyfile)
+
+    if args.pin:
+        args.tls_context.pin_certificates(args.pin)
+
+    # the same context is reused by every reconnect, without reading any files
+    mqtt_client = mqtt.Client(client_id=args.client_id)
+    mqtt_client.tls_set_context(args.tls_context)
+    if args.pin:
+        # the pinned context skips hostname checks; tell paho explicitly rather than
+        # relying on it reading check_hostname in tls_set_context()
+        mqtt_client.tls_insecure_set(True)
+    mqtt_client.enable_logger()
 
     if args.ubx:
         logging.info('Writing all receiver data to %s', args.ubx.name)
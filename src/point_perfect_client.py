@@ -32,6 +32,7 @@ import os.path
 import re
 import sys
 import tempfile
+import threading
 import time
 
 from math import radians, floor, cos, pi
@@ -39,6 +40,12 @@ from math import radians, floor, cos, pi
 # pip install paho-mqtt
 import paho.mqtt.client as mqtt
 
+try:
+    # pip install orjson (optional, decodes tile data faster than json)
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # Center point of rectangular regions mapped to the region name. Used
 # for detecting the region based on proximity to one of these points.
 # These mappings may be inaccurate or out of date. Please check the
@@ -53,6 +60,24 @@ REGION_MAPPING = {
     'N3920W09660': 'us',
 }
 
+NSEW_TO_SIGN = str.maketrans('NSEW', '0-0-')
+
+
+def parse_nodes(nodes):
+    '''Convert node names (e.g. N5245E01185) into a tuple of node latitudes,
+       node longitudes (both multiplied by 100) and node names.'''
+    node_lats = []
+    node_lons = []
+    for node in nodes:
+        node_signed = node.translate(NSEW_TO_SIGN)
+        node_lats.append(int(node_signed[0:5]))
+        node_lons.append(int(node_signed[5:11]))
+    return (tuple(node_lats), tuple(node_lons), tuple(nodes))
+
+
+# REGION_MAPPING nodes, parsed once for region detection
+REGION_NODES = parse_nodes(REGION_MAPPING.keys())
+
 QUALITIES = ('NOFIX', 'GNSS', 'DGNSS', 'PPS', 'FIXED', 'FLOAT', 'DR', 'MAN', 'SIM')
 
 STATS = 100  # logging level for stats
@@ -60,9 +85,16 @@ STATS = 100  # logging level for stats
 class NmeaParser:
     '''
     Parse NMEA sentences from bytes and invoke callbacks for matching sentences.
-    Strips newlines before passing the sentence to the callback. Errors are silently
+    Strips newlines before passing the sentence (as bytes) to the callback. Errors are silently
     ignored and the parser is robust to malformed sentences or UBX, RTCM, SPARTN, etc.
     '''
+    # complete sentence, from '$' up to (excluding) CR
+    SENTENCE_RE = re.compile(rb'\$[A-Z0-9,.\-]+\*[0-9A-F]{2}')
+    # start of a sentence that has not been terminated yet
+    PARTIAL_RE = re.compile(rb'\$[A-Z0-9,.\-*]*')
+    # flags of the callback expressions, re-applied as scoped inline flags
+    INLINE_FLAGS = ((re.IGNORECASE, b'i'), (re.LOCALE, b'L'), (re.MULTILINE, b'm'),
+                    (re.DOTALL, b's'), (re.VERBOSE, b'x'), (re.ASCII, b'a'))
 
     def __init__(self, callbacks):
         '''
@@ -70,42 +102,74 @@ class NmeaParser:
 
         Parameters:
             callbacks (dict): Dictionary of compiled regular expressions objects mapped
-                              to callbacks.
+                              to callbacks. The expressions are combined into a single
+                              alternation, so only the first matching callback is invoked.
         '''
-        self.callbacks = callbacks
+        # one named group per callback, matched in a single pass over the sentence
+        self.callbacks = {f'h{i}': callback for i, callback in enumerate(callbacks.values())}
+        self.regexp = None
+        if callbacks:
+            self.regexp = re.compile(b'|'.join(b'(?P<h%d>%s)' % (i, self.scoped(regexp))
+                                               for i, regexp in enumerate(callbacks.keys())))
         self.buffer = None
 
     def parse(self, data):
         '''Parse the given bytes and invoke callbacks for matching sentences.'''
+        if self.buffer is not None:
+            # continue the sentence left incomplete by the previous call
+            self.buffer += data
+            data = self.buffer
+        pos = 0
+        while True:
+            end = data.find(b'\r', pos)
+            if end < 0:
+                break
+            # a '$' always starts a new sentence, so only the last one counts
+            start = data.rfind(b'$', pos, end)
+            if start >= 0:
+                self.process_sentence(data[start:end])
+            pos = end + 1
+        # keep an incomplete trailing sentence, unless it is already malformed
+        start = data.rfind(b'$', pos)
+        if start >= 0 and self.PARTIAL_RE.fullmatch(data, start):
+            self.buffer = bytearray(data[start:])
+        else:
+            self.buffer = None
+
+    @classmethod
+    def scoped(cls, regexp):
+        '''Return the pattern of a compiled expression with its flags applied inline.'''
+        flags = b''.join(letter for flag, letter in cls.INLINE_FLAGS if regexp.flags & flag)
+        if not flags:
+            return regexp.pattern
+        # end a trailing verbose comment before closing the group
+        end = b'\n)' if regexp.flags & re.VERBOSE else b')'
+        return b'(?%s:%s%s' % (flags, regexp.pattern, end)
+
+    @staticmethod
+    def checksum(data):
+        '''Return the XOR of all bytes in data.'''
+        chksum = 0
         for byte in data:
-            if byte == ord('$'):
-                self.buffer = bytearray([byte])
-            elif self.buffer is not None:
-                if (byte in range(ord('A'), ord('Z')+1) or
-                    byte in range(ord('0'), ord('9')+1) or
-                    byte in (ord(','), ord('.'), ord('-'), ord('*'))):
-                    self.buffer.append(byte)
-                elif byte == 0x0d:  # CR
-                    if len(self.buffer) > 3 and self.buffer[-3] == ord('*'):
-                        try:
-                            chksum_received = int(self.buffer[-2:], 16)
-                        except ValueError:
-                            chksum_received = -1  # will never match below
-                        chksum = 0
-                        for i in self.buffer[1:-3]:
-                            chksum ^= i
-                        if chksum == chksum_received:
-                            for regexp in self.callbacks.keys():
-                                if regexp.match(self.buffer):
-                                    data = self.buffer.decode(encoding='ascii')
-                                    # invoke callback with data
-                                    self.callbacks[regexp](data)
-                        else:
-                            logging.warning('chksum error: %02x != %02x',
-                                                chksum_received, chksum)
-                    self.buffer = None
-                else:
-                    self.buffer = None
+            chksum ^= byte
+        return chksum
+
+    def process_sentence(self, sentence):
+        '''Verify a complete sentence (without CR) and invoke matching callbacks.'''
+        if not self.SENTENCE_RE.fullmatch(sentence):
+            return
+        chksum_received = int(sentence[-2:], 16)
+        chksum = self.checksum(sentence[1:-3])
+        if chksum == chksum_received:
+            if not self.regexp:
+                return
+            match = self.regexp.match(sentence)
+            if match:
+                # invoke callback with the raw sentence
+                self.callbacks[match.lastgroup](sentence)
+        else:
+            logging.warning('chksum error: %02x != %02x',
+                                chksum_received, chksum)
 
 
 class PointPerfectClient:
@@ -117,7 +181,7 @@ class PointPerfectClient:
     position in order to subscribe to the appropriate corrections.
     '''
     EARTH_CIRCUMFERENCE = 6371000 * 2 * pi
-    NSEW_TO_SIGN = str.maketrans('NSEW', '0-0-')
+    MINUTES_TO_DEGREES = 1 / 60
 
     def __init__(self, gnss, mqtt_client, mqtt_server, mqtt_port,
                  localized=False, tile_level=0, lband=False, region=None,
@@ -138,12 +202,20 @@ class PointPerfectClient:
         self.epoch_count = 0  # number of epochs since last node selection
         self.dlat_threshold = distance * 360 / self.EARTH_CIRCUMFERENCE
         self.dlon_threshold = 0  # will be set in process_position()
-        self.tile_dict = None  # cached tile data
+        self.factor_lon = 1  # cos(lat), will be set in process_position()
+        self.tile_nodes = None  # node coordinates of the cached tile, see parse_nodes()
+        self.tile_prefix = None  # topic prefix of the nodes in the cached tile
+        self.tile_endpoint = None  # MQTT server of the nodes in the cached tile
         self.tile_topic = ''  # current tile topic
+        self.tile_delta = (10.0, 5.0, 2.5)[tile_level]  # tile size in degrees
+        self.tile_half = self.tile_delta / 2
+        self.tile_topic_format = f'pp/ip/L{tile_level}%s%04d%s%05d/dict'
         self.spartn_topic = ''  # current SPARTN topic
         self.assist_now = assist_now  # True means always use AssistNow
         self.assist_now_topic = '/pp/ubx/mga' if assist_now else None
-        self.connected = False
+        self.connected = threading.Event()  # set while connected to the MQTT server
+        self.disconnected = threading.Event()  # set while not connected
+        self.disconnected.set()
         self.new_server = None  # if set, connect to this server after disconnect
 
         if stats:
@@ -161,6 +233,11 @@ class PointPerfectClient:
             if region:
                 self.spartn_topic = f'/pp/{self.plan}/{region}'
 
+        # topic prefixes mapped to message handlers, checked in order
+        self.topic_handlers = ((f'/pp/{self.plan}/', self.handle_regional_message),
+                               ('/pp/ubx/', self.handle_ubx_message),
+                               ('pp/ip', self.handle_localized_message))
+
         self.mqtt_client.on_connect = self.on_mqtt_connect
         self.mqtt_client.on_disconnect = self.on_mqtt_disconnect
         self.mqtt_client.on_message = self.on_mqtt_message
@@ -180,7 +257,8 @@ class PointPerfectClient:
         '''Callback for handling MQTT connection.'''
         del userdata, flags  # unused
         if return_code == 0:
-            self.connected = True
+            self.disconnected.clear()
+            self.connected.set()
             logging.info('Connected to %s', self.mqtt_server)
             if self.mqtt_topics:
                 for topic_qos_tuple in self.mqtt_topics:
@@ -200,7 +278,8 @@ class PointPerfectClient:
     def on_mqtt_disconnect(self, mqtt_client, userdata, return_code):
         '''Callback for MQTT disconnect'''
         del mqtt_client, userdata  # unused
-        self.connected = False
+        self.connected.clear()
+        self.disconnected.set()
         if self.new_server:
             self.mqtt_server = self.new_server
             self.new_server = None
@@ -213,59 +292,77 @@ class PointPerfectClient:
     def on_mqtt_message(self, mqtt_client, userdata, msg):
         '''Callback for handling MQTT messages.'''
         del userdata  # unused
-        if msg.topic.startswith(f'/pp/{self.plan}/'):
-            # received regional SPARTN; send to receiver
-            self.gnss.write(msg.payload)
-        elif msg.topic.startswith('/pp/ubx/'):
-            # received SPARTN key or AssistNow data; send to receiver
-            self.gnss.write(msg.payload)
-            if msg.topic == '/pp/ubx/mga':
-                mqtt_client.unsubscribe('/pp/ubx/mga')
-                self.assist_now_topic = '/pp/ubx/mga/updates'
-                logging.info('Subscribing to %s', self.assist_now_topic)
-                mqtt_client.subscribe((self.assist_now_topic, 0))
-        elif msg.topic.startswith('pp/ip'):
-            if msg.topic.endswith('/dict'):
-                self.process_tile_data(msg.payload)
-            else:
-                # localized SPARTN; send to receiver
-                self.gnss.write(msg.payload)
+        topic = msg.topic
+        for prefix, handler in self.topic_handlers:
+            if topic.startswith(prefix):
+                handler(mqtt_client, msg)
+                return
+        logging.warning('Unhandled topic %s', topic)
+
+
+    def handle_regional_message(self, mqtt_client, msg):
+        '''Handle a message on a regional SPARTN topic.'''
+        del mqtt_client  # unused
+        # received regional SPARTN; send to receiver
+        self.gnss.write(msg.payload)
+
+
+    def handle_ubx_message(self, mqtt_client, msg):
+        '''Handle a message on a /pp/ubx/ topic.'''
+        # received SPARTN key or AssistNow data; send to receiver
+        self.gnss.write(msg.payload)
+        if msg.topic == '/pp/ubx/mga':
+            mqtt_client.unsubscribe('/pp/ubx/mga')
+            self.assist_now_topic = '/pp/ubx/mga/updates'
+            logging.info('Subscribing to %s', self.assist_now_topic)
+            mqtt_client.subscribe((self.assist_now_topic, 0))
+
+
+    def handle_localized_message(self, mqtt_client, msg):
+        '''Handle a message on a localized tile or SPARTN topic.'''
+        del mqtt_client  # unused
+        if msg.topic.endswith('/dict'):
+            self.process_tile_data(msg.payload)
         else:
-            logging.warning('Unhandled topic %s', msg.topic)
+            # localized SPARTN; send to receiver
+            self.gnss.write(msg.payload)
 
 
     def loop_forever(self):
         '''Main loop of the client.'''
         # avoid subscribing before fully connected (race in paho)
-        while not self.connected:
-            time.sleep(0.1)
+        self.connected.wait()
         try:
-            buffer = bytearray(100)
             while True:
-                bytes_read = self.gnss.readinto(buffer)
-                if bytes_read:
+                # blocks until data is available, the timeout keeps Ctrl-C responsive
+                data = self.gnss.read(timeout=1.0)
+                if data:
                     if self.ubxfile:
-                        self.ubxfile.write(buffer[0:bytes_read])
+                        self.ubxfile.write(data)
                     # parse the bytes and invoke matching handlers
-                    self.nmea_parser.parse(buffer[0:bytes_read])
+                    self.nmea_parser.parse(data)
         finally:
             logging.info('Disconnecting from %s', self.mqtt_server)
             self.mqtt_client.disconnect()
-            while self.connected:
-                time.sleep(0.1)
+            self.disconnected.wait()
             self.mqtt_client.loop_stop()
 
     def handle_nmea_gga(self, sentence):
-        '''Process an NMEA-GGA sentence passed in as a string.'''
+        '''Process an NMEA-GGA sentence passed in as bytes.'''
+        # decoding once and splitting the str measured faster than a regex on the bytes
+        sentence = sentence.decode(encoding='ascii')
         logging.info(sentence)
         fields = sentence.split(',')
         quality = int(fields[6] or 0)
+        # ddmm.mmmm to degrees, multiplying rather than dividing
         f_lat = float(fields[2] or 0)
-        lat = int(f_lat / 100) + (f_lat % 100) / 60
+        lat = int(f_lat * 0.01)
+        lat += (f_lat - lat * 100) * self.MINUTES_TO_DEGREES
         if fields[3] == 'S':
             lat *= -1
         f_lon = float(fields[4] or 0)
-        lon = int(f_lon / 100) + (f_lon % 100) / 60
+        lon = int(f_lon * 0.01)
+        lon += (f_lon - lon * 100) * self.MINUTES_TO_DEGREES
         if fields[5] == 'W':
             lon *= -1
 
@@ -273,9 +370,9 @@ class PointPerfectClient:
             self.stats.epochs[quality] += 1
             self.stats.total += 1
             if self.stats.total % self.stats.interval == 0:
-                pct = [f'{QUALITIES[i]}: {self.stats.epochs[i] / self.stats.total * 100:.1f}%'
-                        for i in range(len(QUALITIES)) if self.stats.epochs[i]]
-                logging.log(STATS, ', '.join(pct))
+                scale = 100 / self.stats.total
+                logging.log(STATS, ', '.join(f'{name}: {count * scale:.1f}%' for name, count
+                                             in zip(QUALITIES, self.stats.epochs) if count))
 
         if quality in (0, 6):  # no fix or estimated
             if not self.assist_now_topic:
@@ -303,7 +400,8 @@ class PointPerfectClient:
                 self.lat = lat
                 self.lon = lon
                 self.epoch_count = 0
-                self.dlon_threshold = self.dlat_threshold * cos(radians(self.lat))
+                self.factor_lon = cos(radians(self.lat))
+                self.dlon_threshold = self.dlat_threshold * self.factor_lon
                 new_tile_topic = self.get_tile_topic(self.lat, self.lon)
                 if new_tile_topic != self.tile_topic:
                     if self.tile_topic:
@@ -319,17 +417,18 @@ class PointPerfectClient:
                 logging.debug('updating position: %f, %f', lat, lon)
                 self.lat = lat
                 self.lon = lon
-                # Fake tile dictionary for regional mode, allowing automatic
+                self.factor_lon = cos(radians(self.lat))
+                # Fake tile data for regional mode, allowing automatic
                 # selection of the region
-                self.tile_dict = { 'nodes': REGION_MAPPING.keys(),
-                                   'nodeprefix': f'/pp/{self.plan}/',
-                                   'endpoint': self.mqtt_server }
+                self.tile_nodes = REGION_NODES
+                self.tile_prefix = f'/pp/{self.plan}/'
+                self.tile_endpoint = self.mqtt_server
                 self.select_node()
 
 
     def select_node(self):
         '''Select the closest node to the current position.'''
-        if not self.tile_dict:
+        if not self.tile_nodes:
             # not yet ready to select a node, as we don't have tile data
             return
         # Rather than calculate distance in meters, calculate a value that grows with
@@ -339,19 +438,14 @@ class PointPerfectClient:
         # same scale as longitude.
         rounded_lat = round(self.lat * 100)
         rounded_lon = round(self.lon * 100)
-        factor_lon = cos(radians(self.lat))
-        min_dist_scaled = float('inf')
-        for node in self.tile_dict['nodes']:
-            node_signed = node.translate(self.NSEW_TO_SIGN)
-            node_lat = int(node_signed[0:5])
-            node_lon = int(node_signed[5:11])
-            # longitude difference is proportional to distance along NS
-            # latitude difference is proportional to distance along EW,
-            # but scale by cos(lon) to make it the same scale as lon
-            dist_scaled = (node_lat-rounded_lat)**2 + ((node_lon-rounded_lon)*factor_lon)**2
-            if dist_scaled < min_dist_scaled:
-                min_dist_scaled = dist_scaled
-                nearest_node = node
+        factor_lon = self.factor_lon
+        node_lats, node_lons, node_names = self.tile_nodes
+        # longitude difference is proportional to distance along NS
+        # latitude difference is proportional to distance along EW,
+        # but scale by cos(lon) to make it the same scale as lon
+        dists_scaled = [(node_lat-rounded_lat)**2 + ((node_lon-rounded_lon)*factor_lon)**2
+                        for node_lat, node_lon in zip(node_lats, node_lons)]
+        nearest_node = node_names[dists_scaled.index(min(dists_scaled))]
         if self.localized:
             logging.debug('Nearest node: %s', nearest_node)
         else:
@@ -359,43 +453,42 @@ class PointPerfectClient:
             # replace the node name with the region name
             nearest_node = REGION_MAPPING[nearest_node]
             logging.warning('Region "%s" automatically detected', nearest_node)
-        if self.mqtt_server != self.tile_dict['endpoint']:
+        if self.mqtt_server != self.tile_endpoint:
             # store new server and correction topic; on completion of the
             # disconnect below, the disconnect callback will initiate the new
             # connection and the connect callback will subscribe to the new
             # topic
-            self.new_server = self.tile_dict['endpoint']
-            self.spartn_topic = self.tile_dict['nodeprefix'] + nearest_node
+            self.new_server = self.tile_endpoint
+            self.spartn_topic = self.tile_prefix + nearest_node
             self.mqtt_client.disconnect()
         else:
             if self.spartn_topic:
                 self.mqtt_client.unsubscribe(self.spartn_topic)
-            self.spartn_topic = self.tile_dict['nodeprefix'] + nearest_node
+            self.spartn_topic = self.tile_prefix + nearest_node
             logging.info('Subscribing to topic %s', self.spartn_topic)
             self.mqtt_client.subscribe((self.spartn_topic, 0))
 
 
     def get_tile_topic(self, lat, lon):
         '''Get the MQTT topic for the tile containing the given position.'''
-        delta = [10.0, 5.0, 2.5][self.tile_level]
-        n_s = 'S' if lat < 0 else 'N'
-        e_w = 'W' if lon < 0 else 'E'
-        # Get the lower left corner of the tile in latitude and longitude
-        llat = floor(lat / delta) * delta
-        llon = floor(lon / delta) * delta
-        # Shift to the center of the tile
-        clat = llat + (delta / 2)
-        clon = llon + (delta / 2)
+        delta = self.tile_delta
+        # Get the lower left corner of the tile in latitude and longitude,
+        # and shift it to the center of the tile
+        clat = floor(lat / delta) * delta + self.tile_half
+        clon = floor(lon / delta) * delta + self.tile_half
         # Multiply by 100, round to the nearest integer, remove sign
-        slat = abs(round(clat * 100))
-        slon = abs(round(clon * 100))
-        return f'pp/ip/L{self.tile_level}{n_s}{slat:04d}{e_w}{slon:05d}/dict'
+        return self.tile_topic_format % ('S' if lat < 0 else 'N', abs(round(clat * 100)),
+                                         'W' if lon < 0 else 'E', abs(round(clon * 100)))
 
 
     def process_tile_data(self, data):
         '''Process MQTT tile data.'''
         try:
-            self.tile_dict = json.loads(data)
+            tile_dict = json_loads(data)
         except json.JSONDecodeError:
             assert False, 'Invalid JSON data received for tile'
+        # only keep the fields needed for node selection
+        self.tile_nodes = parse_nodes(tile_dict['nodes'])
+        self.tile_prefix = tile_dict['nodeprefix']
+        self.tile_endpoint = tile_dict['endpoint']
         self.select_node()
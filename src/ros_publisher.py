@@ -1,10 +1,16 @@
 import os
-import io
+import queue
+import threading
+from base64 import b64encode
 
 import roslibpy
 
 ROS_HOST = os.environ.get('ROS_HOST', 'localhost')
 ROS_PORT = int(os.environ.get('ROS_PORT', '9090'))
+# correction data is collected for up to FLUSH_DELAY seconds or FLUSH_SIZE bytes
+# and then published as a single message
+FLUSH_DELAY = float(os.environ.get('FLUSH_DELAY', '0.05'))
+FLUSH_SIZE = int(os.environ.get('FLUSH_SIZE', '4096'))
 
 class RosPointPerfectPublisher:
     def __init__(self):
@@ -13,24 +19,49 @@ class RosPointPerfectPublisher:
         self.talker = roslibpy.Topic(self.client, '/ntrip_client/rtcm', 'rtcm_msgs/Message')
         self.listener = roslibpy.Topic(self.client, '/nmea', '/nmea_msgs/Sentence')
         self.listener.subscribe(lambda message: self.on_nmea_message(message))
-        self.nmea_buffer = None
+        self.nmea_queue = queue.SimpleQueue()
+        self.tx_buffer = bytearray()
+        self.tx_lock = threading.Lock()
+        self.tx_timer = None
 
     def __del__(self):
+        self.flush()
         self.talker.unadvertise()
         self.listener.unsubscribe()
         self.client.terminate()
     
     def on_nmea_message(self, message):
-        self.nmea_buffer = io.BytesIO(bytes(message['sentence'] + "\r\n", 'utf-8'))
+        self.nmea_queue.put((message['sentence'] + "\r\n").encode('utf-8'))
     
     def write(self, message):
-        message_to_publish = list(message)
-        self.talker.publish(roslibpy.Message({'message': message_to_publish}))
+        with self.tx_lock:
+            self.tx_buffer += message
+            if len(self.tx_buffer) < FLUSH_SIZE:
+                if self.tx_timer is None:
+                    self.tx_timer = threading.Timer(FLUSH_DELAY, self.flush)
+                    self.tx_timer.daemon = True
+                    self.tx_timer.start()
+                return
+        self.flush()
 
-    def readinto(self, b):
-        if self.nmea_buffer is None:
-            return 0
-        self.nmea_buffer.seek(0)
-        x = self.nmea_buffer.readinto(b)
-        self.nmea_buffer = None
-        return x
+    def flush(self):
+        with self.tx_lock:
+            if self.tx_timer is not None:
+                self.tx_timer.cancel()
+                self.tx_timer = None
+            if self.tx_buffer:
+                # rosbridge accepts uint8[] fields as base64, which avoids one int per byte
+                message_to_publish = b64encode(self.tx_buffer).decode('ascii')
+                self.tx_buffer.clear()
+                # publish while holding the lock to keep the data in order
+                self.talker.publish(roslibpy.Message({'message': message_to_publish}))
+
+    def read(self, timeout=None):
+        # block until a sentence arrives, then take everything queued meanwhile
+        try:
+            sentences = [self.nmea_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return b''
+        while not self.nmea_queue.empty():
+            sentences.append(self.nmea_queue.get_nowait())
+        return b''.join(sentences)